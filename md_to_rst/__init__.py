@@ -13,11 +13,15 @@
     md_to_rst/__init__.py - "Main" module entry point
 '''
 
+import collections
+import multiprocessing
 import re
 import sys
 import traceback
 
-__all__ = ('convertMarkdownToRst', 'ConvertLines', 'ConvertLineData' )
+from .links import FileIndex, LinkRewriter
+
+__all__ = ('convertMarkdownToRst', 'iterConvertMarkdownToRst', 'ConvertLines', 'ConvertLineData', 'ListState', 'LineCache', 'FileIndex', 'LinkRewriter' )
 
 __version__ = '1.1.0'
 __version_tuple__ = (1, 1, 0)
@@ -65,25 +69,545 @@ else:
 
 
 
-def convertMarkdownToRst(contents):
+# MIN_CHUNK_LINES - When converting a document in parallel, the minimum number of lines in each chunk
+MIN_CHUNK_LINES = 2000
+
+# CHUNKS_PER_JOB - When converting a document in parallel, the number of chunks to aim for per process (for load balancing)
+CHUNKS_PER_JOB = 4
+
+
+def convertMarkdownToRst(contents, linkRewriter=None, jobs=None, lineCache=None):
     '''
         convertMarkdownToRst - Take provided markdown and output equivilant restructed text
+
+            @param contents <str> - The markdown document
+
+            @param linkRewriter None or <LinkRewriter> - If provided, the url of every labeled link
+                will be passed through this rewriter ( e.g. to change relative links to .md files into links to .rst files )
+
+                @see md_to_rst.links.FileIndex.getLinkRewriter
+
+            @param jobs None or <int> - If greater than 1, the document is split into chunks at points where
+                no state carries over from one line to the next ( @see _findChunkBoundaries ), and the chunks
+                are converted on a pool of this many processes. The result is identical to converting sequentially.
+
+                Only worthwhile for very large documents; small documents are always converted sequentially.
+
+            @param lineCache None or <LineCache> - If provided, converted lines are memoized in this cache,
+                so repeated lines are not converted again. May be shared between documents.
+
+                When converting in parallel, each process works on its own copy of the cache,
+                  and only the hit and miss counts are added back into #lineCache
+
+            @return <str> - The restructed text document
     '''
     lines = contents.split('\n')
-    numLines = len(lines)
 
-    newLines = []
+    if jobs and jobs > 1 and len(lines) >= MIN_CHUNK_LINES * 2:
+        return _convertMarkdownToRstParallel(lines, linkRewriter, jobs, lineCache)
+
+    return '\n'.join( iterConvertMarkdownToRst(lines, linkRewriter, lineCache) )
+
+
+# FENCE_PREFIXES - Lines starting with these open or close a fenced code block
+FENCE_PREFIXES = ('```', '~~~')
+
+def _findChunkBoundaries(lines, chunkSize):
+    '''
+        _findChunkBoundaries - Find where a document can be split into chunks which convert independently.
+
+            A chunk may begin at a line which is preceded by a blank line, and which has no leading whitespace and is not a list item,
+              outside of any fenced code block.
+
+              At such a line, all lists have ended and the previous line is blank, which is exactly the state
+                at the start of a document ( @see ListState ).
+
+            @param lines list<str> - The lines of the document
+
+            @param chunkSize <int> - The minimum number of lines in each chunk (except the last)
+
+            @return list< tuple(int, int) > - A list of ( start, end ) indexes into #lines for each chunk
+    '''
+    boundaries = []
+
+    numLines = len(lines)
+    chunkStart = 0
+    isInFence = False
 
     for i in range(numLines):
         line = lines[i]
 
-        newLine = ConvertLineData.doConvertLineData(line, lines, i)
+        if line.startswith(FENCE_PREFIXES):
+            isInFence = not isInFence
+            continue
+
+        if isInFence or i - chunkStart < chunkSize:
+            continue
+
+        if not line or line[0] in ' \t' or not line.strip() or lines[i - 1].strip():
+            continue
+
+        if line[0] in ListState.LIST_ITEM_START_CHARS and ListState.LIST_ITEM_RE.match(line):
+            continue
+
+        boundaries.append( (chunkStart, i) )
+        chunkStart = i
+
+    boundaries.append( (chunkStart, numLines) )
+
+    return boundaries
+
+
+# _chunkLinkRewriter - Within a worker process of #_convertMarkdownToRstParallel, the LinkRewriter to use
+_chunkLinkRewriter = None
+
+# _chunkLineCache - Within a worker process of #_convertMarkdownToRstParallel, the LineCache to use
+_chunkLineCache = None
+
+def _initChunkWorker(linkRewriter, lineCache):
+    '''
+        _initChunkWorker - Initializer for the worker processes of #_convertMarkdownToRstParallel
+    '''
+    global _chunkLinkRewriter, _chunkLineCache
+    _chunkLinkRewriter = linkRewriter
+    _chunkLineCache = lineCache
+
+def _convertChunk(chunkContents):
+    '''
+        _convertChunk - Convert a single chunk of a document, within a worker process
+
+            @param chunkContents <str> - The lines of the chunk, joined by newlines
+
+            @return tuple<str, list<str>, int, int> - The converted chunk, any broken links found within it,
+                and the number of line cache hits and misses while converting it
+    '''
+    linkRewriter = _chunkLinkRewriter
+    if linkRewriter is not None:
+        linkRewriter.brokenLinks = []
+
+    lineCache = _chunkLineCache
+    if lineCache is not None:
+        (prevHits, prevMisses) = (lineCache.hits, lineCache.misses)
+
+    rstContents = '\n'.join( iterConvertMarkdownToRst(chunkContents.split('\n'), linkRewriter, lineCache) )
+
+    brokenLinks = []
+    if linkRewriter is not None:
+        brokenLinks = linkRewriter.brokenLinks
+
+    if lineCache is not None:
+        return ( rstContents, brokenLinks, lineCache.hits - prevHits, lineCache.misses - prevMisses )
+
+    return ( rstContents, brokenLinks, 0, 0 )
+
+def _convertMarkdownToRstParallel(lines, linkRewriter, jobs, lineCache):
+    '''
+        _convertMarkdownToRstParallel - Convert a document by splitting it into chunks, and converting those on a process pool.
+
+            @see convertMarkdownToRst
+    '''
+    chunkSize = max( MIN_CHUNK_LINES, len(lines) // (jobs * CHUNKS_PER_JOB) )
+
+    chunks = [ '\n'.join(lines[start : end]) for (start, end) in _findChunkBoundaries(lines, chunkSize) ]
+    if len(chunks) == 1:
+        return '\n'.join( iterConvertMarkdownToRst(lines, linkRewriter, lineCache) )
+
+    pool = multiprocessing.Pool( min(jobs, len(chunks)), initializer=_initChunkWorker, initargs=(linkRewriter, lineCache) )
+    try:
+        results = list( pool.imap(_convertChunk, chunks) )
+    finally:
+        pool.close()
+        pool.join()
+
+    for (rstContents, brokenLinks, hits, misses) in results:
+        if linkRewriter is not None:
+            linkRewriter.brokenLinks += brokenLinks
+        if lineCache is not None:
+            lineCache.hits += hits
+            lineCache.misses += misses
+
+    return '\n'.join( [ result[0] for result in results ] )
+
+
+def iterConvertMarkdownToRst(lines, linkRewriter=None, lineCache=None):
+    '''
+        iterConvertMarkdownToRst - Convert markdown to restructed text a line at a time, without holding the whole document in memory.
+
+            The conversion rules only look at the current line, the one before it, and the lists which are open
+              (tracked by a #ListState), so only those are retained.
+
+            @param lines iterable<str> - The lines of the markdown document, without trailing newlines
+                ( e.g. contents.split('\n') , or a generator reading from a file )
+
+            @param linkRewriter None or <LinkRewriter> - @see convertMarkdownToRst
+
+            @param lineCache None or <LineCache> - @see convertMarkdownToRst
+
+            @return generator<str> - Generator of the lines of the restructed text document
+    '''
+    prevLine = None
+    listState = ListState()
+
+    for line in lines:
+
+        if prevLine is None:
+            window = [ line ]
+            curIdx = 0
+        else:
+            window = [ prevLine, line ]
+            curIdx = 1
+
+        normalizedLine = ConvertLines._replaceLeadingWhitespace(line)
+        listState.update(normalizedLine)
+
+        # Links are not cached when being rewritten, as the rewriter records broken links
+        if lineCache is not None and ( linkRewriter is None or '[' not in normalizedLine ):
+            cacheKey = listState.getCacheKey(normalizedLine)
+
+            convertedLines = lineCache.get(cacheKey)
+            if convertedLines is None:
+                newLine = ConvertLineData.doConvertLineData(normalizedLine, window, curIdx, linkRewriter, listState)
+                convertedLines = tuple( ConvertLines.doConvertLine(newLine, window, curIdx, listState) )
+
+                lineCache.put(cacheKey, convertedLines)
+        else:
+            newLine = ConvertLineData.doConvertLineData(normalizedLine, window, curIdx, linkRewriter, listState)
+            convertedLines = ConvertLines.doConvertLine(newLine, window, curIdx, listState)
+
+        for convertedLine in convertedLines:
+            yield convertedLine
+
+        prevLine = line
 
-        convertedLines = ConvertLines.doConvertLine(newLine, lines, i)
 
-        newLines += convertedLines
+class LineCache(object):
+    '''
+        LineCache - A bounded, least-recently-used memo of converted lines, for documents which repeat the same lines many times.
+
+          The key is the line (with leading whitespace replaced) plus the parts of the #ListState which affect its conversion
+            ( @see ListState.getCacheKey ), so a hit gives exactly the same result as converting the line.
+
+          #hits and #misses are counted, and #hitRate can be used to tune #maxSize
+    '''
+
+    # DEFAULT_MAX_SIZE - The default number of entries to keep
+    DEFAULT_MAX_SIZE = 4096
+
+    def __init__(self, maxSize=DEFAULT_MAX_SIZE):
+        '''
+            __init__ - Create a LineCache
 
-    return '\n'.join(newLines)
+                @param maxSize <int> - The maximum number of entries. When full, the least recently used entry is discarded.
+        '''
+        if maxSize < 1:
+            raise ValueError('maxSize must be at least 1')
+
+        self.maxSize = maxSize
+
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = collections.OrderedDict()
+
+    def get(self, key):
+        '''
+            get - Get the converted lines for a key, marking it as most recently used.
+
+                @param key <tuple> - @see ListState.getCacheKey
+
+                @return None or tuple<str> - The converted lines, or None if not in the cache
+        '''
+        entries = self._entries
+
+        value = entries.pop(key, None)
+        if value is None:
+            self.misses += 1
+            return None
+
+        entries[key] = value
+        self.hits += 1
+
+        return value
+
+    def put(self, key, value):
+        '''
+            put - Add converted lines to the cache, discarding the least recently used entry if full
+
+                @param key <tuple> - @see ListState.getCacheKey
+
+                @param value tuple<str> - The converted lines
+        '''
+        entries = self._entries
+
+        entries[key] = value
+        if len(entries) > self.maxSize:
+            entries.popitem(last=False)
+
+    def clear(self):
+        '''
+            clear - Remove all entries, and reset the hit and miss counts
+        '''
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def hitRate(self):
+        '''
+            hitRate - The fraction ( 0.0 to 1.0 ) of lookups which were hits
+        '''
+        lookups = self.hits + self.misses
+        if not lookups:
+            return 0.0
+
+        return float(self.hits) / lookups
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return '%s(maxSize=%d, size=%d, hits=%d, misses=%d)' %(self.__class__.__name__, self.maxSize, len(self._entries), self.hits, self.misses)
+
+
+class _ListLevel(object):
+    '''
+        _ListLevel - One entry on the #ListState stack, an open (possibly nested) list
+
+            markerColumn <int> - The column (in the markdown) of the list item markers
+
+            contentColumn <int> - The column (in the markdown) at which the text of the current item begins
+
+            outIndent <str> - The indent placed before the list item markers in the RST
+
+            outContentColumn <int> - The column (in the RST) at which the text of the current item begins
+
+            nextNumber None or <int> - For an ordered list, the number of the next item. None for an unordered list.
+    '''
+
+    def __init__(self, markerColumn, outIndent, nextNumber):
+        self.markerColumn = markerColumn
+        self.contentColumn = markerColumn
+        self.outIndent = outIndent
+        self.outContentColumn = len(outIndent)
+        self.nextNumber = nextNumber
+
+
+class ListState(object):
+    '''
+        ListState - State carried from one line to the next during conversion.
+
+          This holds an indent stack of the lists (unordered '*', '-', '+' or ordered '1.', '1)' ) open at the current line,
+            and the details of the current and previous lines which the conversion rules depend upon.
+
+          Each line is examined once, by #update, so rules which depend on the previous line do not need to examine it again.
+
+          Lines which are part of a list (items, and the text within an item) are re-indented such that nested lists
+            line up with the text of their parent item, as RST requires. Ordered lists are renumbered sequentially
+            from their first number, as markdown renders them.
+    '''
+
+    # LIST_ITEM_RE - Matches the marker of a list item, after any leading whitespace has been removed.
+    LIST_ITEM_RE = re.compile('^(?P<marker>[*+\\-]|(?P<number>[0-9]{1,9})(?P<delimiter>[.)]))(?P<space>[ \\t]+)(?=[^ \\t])')
+
+    # HORIZONTAL_RULE_RE - Matches a horizontal rule ( like * * * ), which would otherwise look like a list item
+    HORIZONTAL_RULE_RE = re.compile('^(?P<char>[*\\-_])[ \\t]*((?P=char)[ \\t]*){2,}$')
+
+    # LIST_ITEM_START_CHARS - Characters which may begin a list item, to skip the regex for most lines
+    LIST_ITEM_START_CHARS = frozenset('*+-0123456789')
+
+    def __init__(self):
+        # stack - The open lists, outermost first
+        self.stack = []
+
+        # The current line
+        self.isBlank = True
+        self.indentLevel = 0
+        self.leadingWhitespaceLen = 0
+        self.isUnderline = False
+
+        # isListLine - True if the current line is part of a list (an item, or the text of an item)
+        self.isListLine = False
+        # isListItem - True if the current line begins a list item
+        self.isListItem = False
+        # listLineOrigPrefix - If #isListLine, the leading portion of the line ( whitespace and any marker ) to replace
+        self.listLineOrigPrefix = ''
+        # listLinePrefix - If #isListLine, what to replace #listLineOrigPrefix with
+        self.listLinePrefix = ''
+
+        # The previous line. Before the first line, treated as a blank line.
+        self.prevIsBlank = True
+        self.prevIndentLevel = 0
+        self.prevLeadingWhitespaceLen = 0
+        self.prevIsUnderline = False
+        self.prevIsListLine = False
+
+    @classmethod
+    def fromLines(cls, line, lines, curIdx):
+        '''
+            fromLines - Create a ListState for a line without having converted the lines before it,
+                          for when ConvertLines.doConvertLine or ConvertLineData.doConvertLineData are called directly.
+
+                Only the previous line is considered, so lists which began before it are not known.
+
+                @param line <str> - The current line
+
+                @param lines list<str> - The list of all lines in the markdown file
+
+                @param curIdx <int> - The index of "line" in "lines"
+
+                @return <ListState> - State which has been updated through #line
+        '''
+        listState = cls()
+        if curIdx > 0:
+            listState.update( ConvertLines._replaceLeadingWhitespace(lines[curIdx - 1]) )
+        listState.update( ConvertLines._replaceLeadingWhitespace(line) )
+
+        return listState
+
+    def getCacheKey(self, line):
+        '''
+            getCacheKey - Get the key used by #LineCache for the current line.
+
+                This is everything which affects how the line is converted: the line itself, the details of the previous line,
+                  and (only if the line is part of a list) its new prefix.
+
+                @param line <str> - The current line, with leading whitespace already replaced
+
+                @return <tuple> - The key
+        '''
+        if self.isListLine:
+            listKey = (self.isListItem, self.listLinePrefix)
+        else:
+            listKey = None
+
+        return (line, self.prevIsBlank, self.prevIndentLevel, self.prevLeadingWhitespaceLen, self.prevIsUnderline, listKey)
+
+    def update(self, line):
+        '''
+            update - Advance the state to the next line
+
+                @param line <str> - The next line, with leading whitespace already replaced (@see ConvertLines._replaceLeadingWhitespace)
+        '''
+        self.prevIsBlank = self.isBlank
+        self.prevIndentLevel = self.indentLevel
+        self.prevLeadingWhitespaceLen = self.leadingWhitespaceLen
+        self.prevIsUnderline = self.isUnderline
+        self.prevIsListLine = self.isListLine
+
+        self.isListLine = False
+        self.isListItem = False
+
+        if line and line[0] not in ' \t':
+            # Most lines have no leading whitespace, so skip measuring it
+            content = line
+            leadingWhitespace = ''
+
+            self.indentLevel = 0
+            self.leadingWhitespaceLen = 0
+            column = 0
+        else:
+            content = line.lstrip(' \t')
+            leadingWhitespace = line[ : len(line) - len(content) ]
+
+            # Leading whitespace has already been replaced, so there are no runs of #NUM_SPACES_PER_TAB spaces left,
+            #   and each tab is one indent level.
+            numTabs = leadingWhitespace.count('\t')
+            self.indentLevel = numTabs
+            self.leadingWhitespaceLen = len(leadingWhitespace)
+            column = numTabs * NUM_SPACES_PER_TAB + len(leadingWhitespace) - numTabs
+
+        if not content or ( content[0].isspace() and not content.strip() ):
+            # Blank lines do not end a list by themselves, what follows them decides.
+            self.isBlank = True
+            self.isUnderline = False
+            return
+
+        self.isBlank = False
+        self.isUnderline = line[0] in '-='
+
+        matchObj = None
+        if content[0] in self.LIST_ITEM_START_CHARS:
+            matchObj = self.LIST_ITEM_RE.match(content)
+            if matchObj and self.HORIZONTAL_RULE_RE.match(content):
+                matchObj = None
+
+        if matchObj:
+            self._updateListItem(leadingWhitespace, column, matchObj)
+        elif self.stack:
+            self._updateListText(leadingWhitespace, column, content)
+
+    def _updateListItem(self, leadingWhitespace, column, matchObj):
+        '''
+            _updateListItem - Update the stack for a line which looks like a list item
+        '''
+        stack = self.stack
+
+        while stack and column < stack[-1].markerColumn:
+            stack.pop()
+
+        groupDict = matchObj.groupdict()
+        number = groupDict['number']
+        if number is not None:
+            number = int(number)
+
+        if stack and column < stack[-1].contentColumn:
+            # Another item in the same list
+            level = stack[-1]
+            if (number is None) != (level.nextNumber is None):
+                # Switching between ordered and unordered starts a new list
+                level.nextNumber = number
+        elif stack:
+            # Indented to the text of the parent item, so a nested list
+            level = _ListLevel(column, ' ' * stack[-1].outContentColumn, number)
+            stack.append(level)
+        else:
+            # A new list. If indented a full level, this is preformatted text, and an ordered list
+            #   can only interrupt a paragraph if it starts at 1.
+            if column >= NUM_SPACES_PER_TAB:
+                return
+            if not self.prevIsBlank and number not in (None, 1):
+                return
+
+            level = _ListLevel(column, leadingWhitespace, number)
+            stack.append(level)
+
+        if level.nextNumber is None:
+            marker = groupDict['marker']
+        else:
+            marker = str(level.nextNumber) + groupDict['delimiter']
+            level.nextNumber += 1
+
+        origPrefix = matchObj.group(0)
+
+        level.contentColumn = column + len(origPrefix)
+        level.outContentColumn = len(level.outIndent) + len(marker) + len(groupDict['space'])
+
+        self.isListLine = True
+        self.isListItem = True
+        self.listLineOrigPrefix = leadingWhitespace + origPrefix
+        self.listLinePrefix = level.outIndent + marker + groupDict['space']
+
+    def _updateListText(self, leadingWhitespace, column, content):
+        '''
+            _updateListText - Update the stack for a non-blank line which is not a list item, while within a list
+        '''
+        stack = self.stack
+
+        if self.prevIsBlank or content.startswith('#'):
+            # After a blank line, text must be indented to the text of an item to remain within it
+            while stack and column < stack[-1].contentColumn:
+                stack.pop()
+
+            if not stack or column >= stack[-1].contentColumn + NUM_SPACES_PER_TAB:
+                # Either the list has ended, or this is preformatted text within the item
+                return
+
+        elif not self.prevIsListLine or self.isUnderline:
+            return
+
+        self.isListLine = True
+        self.listLineOrigPrefix = leadingWhitespace
+        self.listLinePrefix = ' ' * stack[-1].outContentColumn
 
 
 class ConvertLines(object):
@@ -97,7 +621,7 @@ class ConvertLines(object):
     '''
 
     @classmethod
-    def doConvertLine(cls, line, lines, curIdx):
+    def doConvertLine(cls, line, lines, curIdx, listState=None):
         '''
             doConvertLine - Take a line of markdown, and return the converted RST lines
 
@@ -107,18 +631,25 @@ class ConvertLines(object):
 
                 @param curIdx <int> - The index of "line" in "lines"
 
+                @param listState None or <ListState> - The state, already updated through this line.
+                    If provided, #line must already have its leading whitespace replaced (@see _replaceLeadingWhitespace).
+                    If None, one is created from the previous line (@see ListState.fromLines)
+
 
                 @return list<str> - A list of converted lines
         '''
 
-        line = cls._replaceLeadingWhitespace(line)
-
+        if listState is None:
+            line = cls._replaceLeadingWhitespace(line)
+            listState = ListState.fromLines(line, lines, curIdx)
 
-        if cls._isTabbedLine(line):
-            return cls._convertTabbedLine(line, lines, curIdx)
+        if listState.isListLine:
+            return cls._convertListLine(line, listState)
+        elif cls._isTabbedLine(line):
+            return cls._convertTabbedLine(line, listState)
         elif cls._isHashTitleLine(line):
             return cls._convertHashTitle(line)
-        elif cls._isNeedingLineBreak(line, lines, curIdx):
+        elif cls._isNeedingLineBreak(line, listState):
             return cls._addLineBreak(line)
         else:
             return [line]
@@ -132,38 +663,35 @@ class ConvertLines(object):
         return line.startswith('\t')
 
     @classmethod
-    def _convertTabbedLine(cls, line, lines, curIdx):
+    def _convertTabbedLine(cls, line, listState):
         '''
             _convertTabbedLine - Convert an indented line (starts with tab) to RST.
 
                 Will prepend an empty line, to ensure breaking occurs as it did in the markdown.
         '''
-        if curIdx == 0:
-            return [line]
-        if not line.strip():
-            return [line]
-
-        prevLine = lines[curIdx - 1]
-
-        if not prevLine.strip() or not line.strip():
+        if listState.prevIsBlank or listState.isBlank:
             return [line]
 
         return ['', line]
 
-
-    UNORDERED_LIST_RE = re.compile('[\s]{0,%d[ ][ \\t]+' %( NUM_SPACES_PER_TAB, ))
-
     @classmethod
-    def _isUnorderedListLine(cls, line):
+    def _convertListLine(cls, line, listState):
         '''
-            _isUnorderedListLine - Detect if line is to be rendered as an unordered list.
+            _convertListLine - Convert a line which is part of a list (an item, or the text of an item) to RST.
 
-              An unordered list begins with 0 to ( NUM_SPACES_PER_TAB - 1 ) spaces, followed by an astrick '*', followed by a (space or tab)
+                The line is re-indented so nested lists line up with the text of their parent item ( @see ListState ).
 
+                An empty line is prepended before each item, as RST requires one before a nested list,
+                  and markdown renders consecutive items as if separated by one.
         '''
+        origPrefix = listState.listLineOrigPrefix
+        if line.startswith(origPrefix):
+            line = listState.listLinePrefix + line[len(origPrefix) : ]
+
+        if listState.isListItem and not listState.prevIsBlank:
+            return ['', line]
 
-        # Check the format
-        return bool( cls.UNORDERED_LIST_RE.match(line) )
+        return [line]
 
 
     # HASH_TITLE_LINE_RE - Regular Expression object to match a line defining a "hash" title (the largest header in markdown).
@@ -282,61 +810,34 @@ class ConvertLines(object):
         return leadingWhitespace + groupDict['content']
 
     @classmethod
-    def _isNeedingLineBreak(cls, line, lines, lineIdx):
+    def _isNeedingLineBreak(cls, line, listState):
         '''
             _isNeedingLineBreak - Check if the provided line would normally trigger a "break" (new line)
               in markdown, but does not in RST.
 
               @param line <str> - The line to check
-              @param lines list<str> - List of all the lines
-              @param lineIdx <int> - The index of "line" within "lines"
+              @param listState <ListState> - The state, updated through this line
 
             If either line is blank (empty or only whitespace), a line break is NOT added.
 
             Otherwise, if the given line and previous line share the same leading whitespace,
               a line break is force-inserted such that MD and RST render the same
-        '''
-        # If first line, don't worry about prior spacing
-        if lineIdx == 0:
-            return False
-
-        # If empty line, don't add extra spacing
-        if not line.strip():
-            return False
 
-        # If previous line is empty, we treat line breaks the same
-        prevLine = lines[lineIdx - 1]
-        if not prevLine.strip():
+            Lines within lists are handled by #_convertListLine instead.
+        '''
+        # If empty line (or the previous line is empty, or this is the first line), don't add extra spacing
+        if listState.isBlank or listState.prevIsBlank:
             return False
 
         # If previous line is the underline of a title, or this line is the underline,
         #   do not add spacing.
-        if prevLine.startswith( ('-', '=') ) or  line.startswith( ('-', '=') ):
-            return False
-
-
-        curWhitespace = cls._getLeadingWhitespace(line)
-        prevWhitespace = cls._getLeadingWhitespace(prevLine)
-
-        curIndentLevel = cls._convertLeadingWhitespaceToIndentLevel(curWhitespace)
-        prevIndentLevel = cls._convertLeadingWhitespaceToIndentLevel(prevWhitespace)
-
-
-        # If an unordered list, there are special rules
-        if cls._isUnorderedListLine(line):
-
-            if curIndentLevel == 0 and prevIndentLevel == 0 and len(curWhitespace) >= len(prevWhitespace):
-                # If we are on the first indent level,
-                #  and have either the same number of prefixed space characters or less,
-                #  markdown forces a linebreak and RST does not.
-                return True
-
-            # Otherwise, indent rules are the same
+        if listState.prevIsUnderline or listState.isUnderline:
             return False
 
-        # Sub list rules seem to be the same, so far as I've tested..
+        curIndentLevel = listState.indentLevel
+        prevIndentLevel = listState.prevIndentLevel
 
-        if curIndentLevel < prevIndentLevel or ( curIndentLevel == prevIndentLevel and len(curWhitespace) >= len(prevWhitespace) ):
+        if curIndentLevel < prevIndentLevel or ( curIndentLevel == prevIndentLevel and listState.leadingWhitespaceLen >= listState.prevLeadingWhitespaceLen ):
             # In MD, if we've went down a full indent level, or if we are at the same level but have more leading spaces than prev line,
             #   we add an implicit line break.
             return True
@@ -361,7 +862,7 @@ class ConvertLineData(object):
     '''
 
     @classmethod
-    def doConvertLineData(cls, line, lines, curIdx):
+    def doConvertLineData(cls, line, lines, curIdx, linkRewriter=None, listState=None):
         '''
             doConvertLineData - Take a line of markdown, and convert the data itself to RST where they are not compatible
 
@@ -371,17 +872,25 @@ class ConvertLineData(object):
 
                 @param curIdx <int> - The index of "line" in "lines"
 
+                @param linkRewriter None or <LinkRewriter> - If provided, used to rewrite the urls of labeled links
+
+                @param listState None or <ListState> - The state, already updated through this line.
+                    If provided, #line must already have its leading whitespace replaced (@see ConvertLines._replaceLeadingWhitespace).
+                    If None, one is created from the previous line (@see ListState.fromLines)
+
 
                 @return <str> - The converted line
         '''
 
-        # TODO: Maybe refactor so we aren't calling across worker classes here?
-        line = ConvertLines._replaceLeadingWhitespace(line)
+        if listState is None:
+            # TODO: Maybe refactor so we aren't calling across worker classes here?
+            line = ConvertLines._replaceLeadingWhitespace(line)
+            listState = ListState.fromLines(line, lines, curIdx)
 
-        # For now, omit the following on preformatted text.
-        if not line.startswith('\t'):
+        # For now, omit the following on preformatted text. Indented lines within a list are not preformatted.
+        if not line.startswith('\t') or listState.isListLine:
             line = cls._convertPointedBrackets(line)
-            line = cls._convertLabeledExternalHyperlink(line)
+            line = cls._convertLabeledExternalHyperlink(line, linkRewriter)
             line = cls._convertUnderscoreDecorations(line)
         else:
             # RST does not know what "preformatted" means and allows unescaped stuff..
@@ -466,7 +975,7 @@ class ConvertLineData(object):
             #  Prefixing the string both allows us to match on the first character in a line,
             #    and causes the returned index (which will point to the char before) to line up
             #    in the right place, by offsetting the whole line right 1.
-            startOrNone = lambda searchResult : searchResult is not None and searchResult.start() or None
+            startOrNone = lambda searchResult : None if searchResult is None else searchResult.start()
 
             startStrRE = re.compile('[^\\\\]' + re.escape(startStr) )
             findNextIdxStart = lambda haystack : startOrNone( startStrRE.search( '^' + haystack ) )
@@ -573,10 +1082,14 @@ class ConvertLineData(object):
 
     URL_RANGES_RE = re.compile('(?P<url>(?:https|http|ftp|smb|file)[:][/][/][^\s]+)')
 
+    # RST_LINK_RANGES_RE - Matches a labeled link which has already been converted to RST ( like `Label <url>`_ ),
+    #   so its trailing underscore is not paired with another as emphasis
+    RST_LINK_RANGES_RE = re.compile('[`][^`]+[<][^>`]*[>][`][_]')
+
     @classmethod
     def _findUrlRanges(cls, line):
         '''
-            _findUrlRanges - Identifies the ranges within a line which define a url,
+            _findUrlRanges - Identifies the ranges within a line which define a url (or a link already converted to RST),
 
                 so they can be ommitted from some formatting operations.
 
@@ -587,15 +1100,20 @@ class ConvertLineData(object):
 
         ret = []
 
-        scanner = cls.URL_RANGES_RE.scanner(line)
+        for (rangesRE, requiredStr) in ( (cls.URL_RANGES_RE, '://'), (cls.RST_LINK_RANGES_RE, '`_') ):
+            # Most lines have neither, so skip the scan
+            if requiredStr not in line:
+                continue
+
+            scanner = rangesRE.scanner(line)
 
-        while True:
+            while True:
 
-            nextUrlMatch = scanner.search()
-            if not nextUrlMatch:
-                break
+                nextUrlMatch = scanner.search()
+                if not nextUrlMatch:
+                    break
 
-            ret.append( tuple(nextUrlMatch.span()) )
+                ret.append( tuple(nextUrlMatch.span()) )
 
         return ret
 
@@ -617,10 +1135,10 @@ class ConvertLineData(object):
                     lambda groupDict : groupDict['url']
         )
 
-    LABELED_EXTERNAL_HYPERLINK_RE = re.compile("""[\[](?P<label>(([\\][\]])|[^\]])+)[\]][ \t]*[\(][ \t]*(?P<url>[^( \t*")\)]+)[ \t]*(["].+["]){0,1}[\)]""")
+    LABELED_EXTERNAL_HYPERLINK_RE = re.compile("""[\[](?P<label>(([\\\\][\]])|[^\]])+)[\]][ \t]*[\(][ \t]*(?P<url>[^( \t*")\)]+)[ \t]*(["].+["]){0,1}[\)]""")
 
     @classmethod
-    def _convertLabeledExternalHyperlink(cls, line):
+    def _convertLabeledExternalHyperlink(cls, line, linkRewriter=None):
         '''
             _convertLabeledExternalHyperlink - Convert an external hyperlink with a label from MD to RST form
 
@@ -628,14 +1146,21 @@ class ConvertLineData(object):
 
                 @param line <str> - The line
 
+                @param linkRewriter None or <LinkRewriter> - If provided, each url is passed through this before being output
+
                 @return <str> - The line with external hyperlinks with labels converted
 
                 NOTE: If the markdown link has a title (hover text), the hover text is dropped as RST does not support it.
                         Example:   [Cool Search Site](https://www.duckduckgo.com "Quack Quack")
         '''
+        if linkRewriter is None:
+            convertUrl = lambda url : url
+        else:
+            convertUrl = linkRewriter.rewriteUrl
+
         return ConvertLineData._replaceSection(line, '[', ')', 
                     cls.LABELED_EXTERNAL_HYPERLINK_RE,
-                    lambda groupDict : "`%s <%s>`_" %(groupDict['label'].strip(), groupDict['url'].strip())
+                    lambda groupDict : "`%s <%s>`_" %(groupDict['label'].strip(), convertUrl(groupDict['url'].strip()))
         )
 
 
@@ -0,0 +1,467 @@
+# vim: set ts=4 sw=4 st=4 expandtab
+'''
+    md_to_rst - Module whose purpose is to convert markdown (md) to restructed text (rst)
+
+    Copyright (c) 2017 Timothy Savannah, All Rights Reserved
+
+    Licensed under terms of the GNU General Public License (GPL) Version 3.0
+
+    You should have recieved a copy of this license as "LICENSE" with the source distribution,
+      otherwise the current license can be found at https://github.com/kata198/mdToRst/blob/master/LICENSE
+
+
+    md_to_rst/build.py - Incremental, make-style conversion of a whole tree of markdown documents
+'''
+
+import errno
+import hashlib
+import io
+import json
+import os
+import stat
+import tempfile
+
+from . import __version__, convertMarkdownToRst
+from .links import FileIndex, DEFAULT_LINK_EXTENSION_MAP
+
+__all__ = ('buildTree', 'BuildResult', 'MANIFEST_FILENAME', 'SOURCE_EXTENSIONS', 'OUTPUT_EXTENSION', 'writeFileAtomic')
+
+
+# MANIFEST_FILENAME - Name of the manifest file, stored at the top of the output directory
+MANIFEST_FILENAME = '.mdToRst-manifest.json'
+
+# MANIFEST_FORMAT - Bumped whenever the layout of the manifest changes. A mismatch discards the manifest.
+MANIFEST_FORMAT = 1
+
+# SOURCE_EXTENSIONS - Files with these extensions are converted
+SOURCE_EXTENSIONS = ('.md', )
+
+# OUTPUT_EXTENSION - The extension given to converted documents
+OUTPUT_EXTENSION = '.rst'
+
+
+try:
+    _replaceFile = os.replace
+except AttributeError:
+    # Python 2, rename is atomic on POSIX
+    _replaceFile = os.rename
+
+try:
+    _scandir = os.scandir
+except AttributeError:
+    _scandir = None
+
+
+def _getMtimeNs(statResult):
+    '''
+        _getMtimeNs - Get the modification time in nanoseconds from a stat result
+    '''
+    mtimeNs = getattr(statResult, 'st_mtime_ns', None)
+    if mtimeNs is None:
+        mtimeNs = int(statResult.st_mtime * 1000000000)
+
+    return mtimeNs
+
+
+def _scanTree(rootDir, skipDir=None):
+    '''
+        _scanTree - Generator which yields every file beneath #rootDir
+
+            @param rootDir <str> - The directory to scan
+
+            @param skipDir None or <str> - The realpath of a directory which should not be descended into
+
+            @return generator< tuple(str, DirEntry/None) > - Tuples of ( relative path, entry ).
+                On python 2 (no os.scandir), entry is None
+    '''
+    if _scandir is None:
+        for dirPath, dirNames, fileNames in os.walk(rootDir):
+            if skipDir is not None:
+                dirNames[:] = [ dirName for dirName in dirNames if os.path.realpath(os.path.join(dirPath, dirName)) != skipDir ]
+
+            relativeDir = os.path.relpath(dirPath, rootDir)
+            for fileName in fileNames:
+                yield ( os.path.normpath(os.path.join(relativeDir, fileName)), None )
+        return
+
+    pendingDirs = [ (rootDir, '') ]
+    while pendingDirs:
+        (dirPath, relativeDir) = pendingDirs.pop()
+
+        for entry in _scandir(dirPath):
+            relativePath = relativeDir and (relativeDir + os.sep + entry.name) or entry.name
+
+            if entry.is_dir(follow_symlinks=False):
+                if skipDir is not None and os.path.realpath(entry.path) == skipDir:
+                    continue
+                pendingDirs.append( (entry.path, relativePath) )
+            elif entry.is_dir():
+                # A symlink to a directory. Like os.walk, do not follow it (and it is not a file)
+                continue
+            else:
+                yield ( relativePath, entry )
+
+
+def _hashContents(contents):
+    '''
+        _hashContents - Get the digest used to tell if a source has changed
+
+            @param contents <bytes> - The raw contents of the source
+
+            @return <str> - Hex digest
+    '''
+    return hashlib.sha1(contents).hexdigest()
+
+
+def _getNewFileMode(filename):
+    '''
+        _getNewFileMode - Get the permissions a file being replaced should end up with
+
+            @param filename <str> - The file about to be written
+
+            @return <int> - The mode of #filename if it exists, otherwise the mode a newly created file would get ( 0666 less the umask )
+    '''
+    try:
+        return stat.S_IMODE( os.stat(filename).st_mode )
+    except OSError:
+        pass
+
+    # The umask can only be read by setting it
+    umask = os.umask(0)
+    os.umask(umask)
+
+    return 0o666 & ~umask
+
+
+def writeFileAtomic(filename, contents):
+    '''
+        writeFileAtomic - Write a file such that readers see either the old or the new contents, never a partial file.
+
+            The data is written to a temporary file in the same directory, which is then renamed over #filename.
+
+            The file gets the same permissions as if it had been written directly (mkstemp creates it as 0600)
+
+            @param filename <str> - The file to write
+
+            @param contents <str> - The text to write (encoded as utf-8)
+    '''
+    if isinstance(contents, bytes):
+        # On python 2, json.dumps and friends return a byte str, which io.open in text mode rejects
+        contents = contents.decode('utf-8')
+
+    dirName = os.path.dirname(filename) or '.'
+
+    (fd, tempFilename) = tempfile.mkstemp(dir=dirName, prefix='.' + os.path.basename(filename) + '.', suffix='.tmp')
+    try:
+        with io.open(fd, 'wt', encoding='utf-8') as f:
+            f.write(contents)
+        os.chmod(tempFilename, _getNewFileMode(filename))
+        _replaceFile(tempFilename, filename)
+    except:
+        try:
+            os.unlink(tempFilename)
+        except:
+            pass
+        raise
+
+
+class BuildResult(object):
+    '''
+        BuildResult - The outcome of a #buildTree run
+
+            converted list<str> - Sources (relative to the source directory) which were converted
+
+            unchanged list<str> - Sources which were up to date, and skipped
+
+            removed list<str> - Outputs (relative to the output directory) which were deleted because their source was removed
+
+            brokenLinks dict<str : list<str>> - If links were rewritten, a map of source -> broken links for each converted source
+
+            errors dict<str : str> - A map of source -> description of the error, for each source which could not be converted
+                (e.g. it is not valid utf-8). These are tried again on the next build.
+    '''
+
+    def __init__(self):
+        self.converted = []
+        self.unchanged = []
+        self.removed = []
+        self.brokenLinks = {}
+        self.errors = {}
+
+    def __repr__(self):
+        return '%s(converted=%d, unchanged=%d, removed=%d, errors=%d)' %(self.__class__.__name__, len(self.converted), len(self.unchanged), len(self.removed), len(self.errors))
+
+
+def _loadManifest(manifestFilename, buildConfig):
+    '''
+        _loadManifest - Load the manifest from a previous build
+
+            @param manifestFilename <str> - Path to the manifest
+
+            @param buildConfig <dict> - The configuration of this build.
+
+            @return tuple<dict, dict, bool> - A tuple of ( the previous build config, map of source -> entry, is up to date ).
+
+                If the converter version or config has changed, "is up to date" is False, and the entries should only be
+                  used to find removed sources (everything else is rebuilt).
+
+                If there is no manifest or it is unreadable, the entries are empty.
+    '''
+    try:
+        with io.open(manifestFilename, 'rt', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (IOError, OSError, ValueError):
+        return ( {}, {}, False )
+
+    if not isinstance(manifest, dict) or manifest.get('format') != MANIFEST_FORMAT:
+        return ( {}, {}, False )
+
+    prevConfig = manifest.get('config') or {}
+    isUpToDate = bool( manifest.get('version') == __version__ and prevConfig == buildConfig )
+
+    return ( prevConfig, manifest.get('sources') or {}, isUpToDate )
+
+
+def _saveManifest(manifestFilename, buildConfig, sources):
+    '''
+        _saveManifest - Atomically write the manifest
+    '''
+    manifest = {
+        'format' : MANIFEST_FORMAT,
+        'version' : __version__,
+        'config' : buildConfig,
+        'sources' : sources,
+    }
+
+    writeFileAtomic(manifestFilename, json.dumps(manifest, sort_keys=True, separators=(',', ':')))
+
+
+def _getOutputPath(sourcePath):
+    '''
+        _getOutputPath - Get the path of the output for a given source path
+    '''
+    return os.path.splitext(sourcePath)[0] + OUTPUT_EXTENSION
+
+
+def _removeEmptyParents(outDir, outputPath):
+    '''
+        _removeEmptyParents - After removing an output, remove any directories it leaves empty (up to, but not including, #outDir)
+    '''
+    dirName = os.path.dirname(outputPath)
+    while dirName:
+        try:
+            os.rmdir(os.path.join(outDir, dirName))
+        except OSError:
+            break
+        dirName = os.path.dirname(dirName)
+
+
+def _hasOutput(outDir, outputPath, outputDirListings):
+    '''
+        _hasOutput - Check if an output exists, listing each output directory at most once
+
+            @param outDir <str> - The output directory
+
+            @param outputPath <str> - The path of the output, relative to #outDir
+
+            @param outputDirListings dict<str : set<str>> - The names within each output directory listed so far,
+                keyed by path relative to #outDir. Updated with the listing of this output's directory, if needed.
+
+            @return <bool> - True if the output exists
+    '''
+    (dirName, _sep, baseName) = outputPath.rpartition(os.sep)
+
+    names = outputDirListings.get(dirName)
+    if names is None:
+        try:
+            names = set( os.listdir(os.path.join(outDir, dirName)) )
+        except OSError:
+            names = set()
+        outputDirListings[dirName] = names
+
+    return baseName in names
+
+
+def buildTree(srcDir, outDir, rewriteLinks=False, linkExtensionMap=None, lineCache=None):
+    '''
+        buildTree - Convert every markdown document under #srcDir into restructed text under #outDir,
+
+            only converting what has changed since the last build (like "make").
+
+            A manifest (#MANIFEST_FILENAME) in #outDir records the size, mtime, and content hash of each source, along with
+              the converter version. On a rebuild:
+
+                * If a source's size and mtime match the manifest and its output exists, it is skipped without being read
+                    (each output directory is listed once, rather than a stat per output)
+                * Otherwise, the source is read and hashed. If the hash matches and its output exists, only the manifest is updated
+                * Otherwise, the source is converted and the output is written atomically
+                * Outputs whose source no longer exists are deleted
+
+            A change in converter version or build options causes everything to be rebuilt.
+
+            A source which is not valid utf-8 is recorded in BuildResult.errors, and does not stop the build.
+
+            @param srcDir <str> - The directory containing the markdown
+
+            @param outDir <str> - The directory in which to write the restructed text. Will be created if it does not exist.
+
+            @param rewriteLinks <bool> default False - If True, rewrite relative links as described in md_to_rst.links,
+                using #srcDir as the root. Because adding or removing any file in the tree can change the output of
+                another document, any such change causes everything to be rebuilt.
+
+            @param linkExtensionMap None or dict<str:str> - If #rewriteLinks is True, @see md_to_rst.links.LinkRewriter
+
+            @param lineCache None or <LineCache> - If provided, used to memoize converted lines across all the documents converted
+
+            @return <BuildResult> - What was done
+    '''
+    result = BuildResult()
+
+    try:
+        os.makedirs(outDir)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    outDirReal = os.path.realpath(outDir)
+
+    # Gather the stat data for all sources. This (and reading the manifest) is all the I/O done when nothing has changed
+    sourceStats = {}
+    allPaths = []
+    for (relativePath, entry) in _scanTree(srcDir, skipDir=outDirReal):
+        if rewriteLinks:
+            allPaths.append(relativePath)
+
+        if not relativePath.endswith(SOURCE_EXTENSIONS):
+            continue
+
+        if entry is not None:
+            statResult = entry.stat()
+        else:
+            statResult = os.stat(os.path.join(srcDir, relativePath))
+
+        sourceStats[relativePath] = ( statResult.st_size, _getMtimeNs(statResult) )
+
+    buildConfig = { 'rewriteLinks' : bool(rewriteLinks) }
+    fileIndex = None
+    if rewriteLinks:
+        if linkExtensionMap is None:
+            linkExtensionMap = DEFAULT_LINK_EXTENSION_MAP
+
+        # If OUT_DIR is (or is within) SRC_DIR, the manifest and this build's outputs are not part of the tree.
+        #   Otherwise writing them would change the digest, and force a full rebuild on the next build.
+        outDirRelative = os.path.relpath(outDirReal, os.path.realpath(srcDir))
+        if outDirRelative != os.pardir and not outDirRelative.startswith(os.pardir + os.sep):
+            ownPaths = set( [ os.path.normpath(os.path.join(outDirRelative, MANIFEST_FILENAME)) ] )
+            for relativePath in sourceStats:
+                ownPaths.add( os.path.normpath(os.path.join(outDirRelative, _getOutputPath(relativePath))) )
+
+            allPaths = [ relativePath for relativePath in allPaths if relativePath not in ownPaths ]
+
+        allPaths.sort()
+        buildConfig['linkExtensionMap'] = dict(linkExtensionMap)
+        buildConfig['treeDigest'] = _hashContents( '\n'.join(allPaths).encode('utf-8') )
+        fileIndex = FileIndex(srcDir, allPaths)
+
+    manifestFilename = os.path.join(outDir, MANIFEST_FILENAME)
+    (prevConfig, prevSources, isUpToDate) = _loadManifest(manifestFilename, buildConfig)
+
+    # A dict of all the entries for the new manifest
+    sources = {}
+    isManifestDirty = bool( not isUpToDate or len(prevSources) != len(sourceStats) )
+
+    outputDirListings = {}
+
+    try:
+        for relativePath in sorted(sourceStats):
+            (size, mtimeNs) = sourceStats[relativePath]
+
+            prevEntry = isUpToDate and prevSources.get(relativePath) or None
+
+            outputPath = _getOutputPath(relativePath)
+            hasOutput = prevEntry is not None and _hasOutput(outDir, outputPath, outputDirListings)
+
+            if hasOutput and prevEntry['size'] == size and prevEntry['mtime'] == mtimeNs:
+                # Fast path - stat data unchanged, and the output is still there
+                sources[relativePath] = prevEntry
+                result.unchanged.append(relativePath)
+                continue
+
+            with open(os.path.join(srcDir, relativePath), 'rb') as f:
+                rawContents = f.read()
+
+            contentHash = _hashContents(rawContents)
+            newEntry = { 'size' : size, 'mtime' : mtimeNs, 'hash' : contentHash }
+            isManifestDirty = True
+
+            fullOutputPath = os.path.join(outDir, outputPath)
+
+            if hasOutput and prevEntry['hash'] == contentHash:
+                # Touched but not modified
+                sources[relativePath] = newEntry
+                result.unchanged.append(relativePath)
+                continue
+
+            linkRewriter = None
+            if fileIndex is not None:
+                linkRewriter = fileIndex.getLinkRewriter(relativePath, linkExtensionMap)
+
+            try:
+                contents = rawContents.decode('utf-8')
+            except UnicodeDecodeError as e:
+                result.errors[relativePath] = '%s:  %s' %(type(e).__name__, str(e))
+                continue
+
+            # The hash is of the raw bytes, but newlines are translated as when reading in text mode (like the mdToRst command),
+            #   so a CRLF source converts the same as an LF one.
+            if '\r' in contents:
+                contents = contents.replace('\r\n', '\n').replace('\r', '\n')
+
+            rstContents = convertMarkdownToRst(contents, linkRewriter, lineCache=lineCache)
+
+            outputDir = os.path.dirname(fullOutputPath)
+            if not os.path.isdir(outputDir):
+                os.makedirs(outputDir)
+
+            # Match the output of the mdToRst command, which prints a trailing newline
+            writeFileAtomic(fullOutputPath, rstContents + '\n')
+            sources[relativePath] = newEntry
+
+            result.converted.append(relativePath)
+            if linkRewriter is not None and linkRewriter.brokenLinks:
+                result.brokenLinks[relativePath] = linkRewriter.brokenLinks
+
+        for relativePath in sorted(prevSources):
+            if relativePath in sourceStats:
+                continue
+
+            outputPath = _getOutputPath(relativePath)
+            try:
+                os.unlink(os.path.join(outDir, outputPath))
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+            else:
+                _removeEmptyParents(outDir, outputPath)
+            result.removed.append(outputPath)
+            isManifestDirty = True
+
+    finally:
+        if isManifestDirty:
+            # If an error occured, sources not yet reached (or which failed to convert) keep their previous entries
+            #   so they will be re-checked on the next build, and removed sources are kept so their output is still deleted
+            removedOutputs = set(result.removed)
+            for relativePath, prevEntry in prevSources.items():
+                if relativePath in sources:
+                    continue
+                if relativePath in sourceStats:
+                    if isUpToDate:
+                        sources[relativePath] = prevEntry
+                elif _getOutputPath(relativePath) not in removedOutputs:
+                    sources[relativePath] = prevEntry
+            _saveManifest(manifestFilename, buildConfig, sources)
+
+    return result
+
+
+# vim: set ts=4 sw=4 st=4 expandtab :
@@ -0,0 +1,194 @@
+# vim: set ts=4 sw=4 st=4 expandtab
+'''
+    md_to_rst - Module whose purpose is to convert markdown (md) to restructed text (rst)
+
+    Copyright (c) 2017 Timothy Savannah, All Rights Reserved
+
+    Licensed under terms of the GNU General Public License (GPL) Version 3.0
+
+    You should have recieved a copy of this license as "LICENSE" with the source distribution,
+      otherwise the current license can be found at https://github.com/kata198/mdToRst/blob/master/LICENSE
+
+
+    md_to_rst/check.py - Check that existing restructed text documents are up to date with their markdown sources
+'''
+
+import collections
+import io
+import multiprocessing
+
+from . import iterConvertMarkdownToRst
+
+__all__ = ('checkFile', 'checkFiles', 'CheckResult', 'iterFileLines')
+
+
+# NUM_CONTEXT_LINES - The number of matching lines shown before the first mismatch
+NUM_CONTEXT_LINES = 3
+
+
+class CheckResult(object):
+    '''
+        CheckResult - The result of checking a single markdown / restructed text pair
+
+            mdFilename <str> - The markdown source
+
+            rstFilename <str> - The restructed text being checked
+
+            isMatch <bool> - True if #rstFilename is exactly what #mdFilename converts to
+
+            diff None or <str> - If not a match, a short diff up to and including the first mismatched line
+
+            error None or <str> - If one of the files could not be read (or is not valid utf-8), a description of the error (and #isMatch is False)
+    '''
+
+    def __init__(self, mdFilename, rstFilename, isMatch, diff=None, error=None):
+        self.mdFilename = mdFilename
+        self.rstFilename = rstFilename
+        self.isMatch = isMatch
+        self.diff = diff
+        self.error = error
+
+    def __repr__(self):
+        return '%s(%r, %r, isMatch=%r)' %(self.__class__.__name__, self.mdFilename, self.rstFilename, self.isMatch)
+
+
+def iterFileLines(f):
+    '''
+        iterFileLines - Iterate over the lines of an open file, yielding the same lines as f.read().split('\\n')
+            but without reading the whole file into memory.
+
+            @param f <file> - An open file, in text mode
+
+            @return generator<str> - The lines of the file, without trailing newlines
+    '''
+    endsWithNewline = True
+
+    for line in f:
+        if line.endswith('\n'):
+            yield line[:-1]
+        else:
+            endsWithNewline = False
+            yield line
+
+    if endsWithNewline:
+        yield ''
+
+
+def _iterExpectedLines(mdFile):
+    '''
+        _iterExpectedLines - Generator of the lines of the expected restructed text, as written by the mdToRst command
+
+            ( which is the converted document, followed by a newline )
+    '''
+    for line in iterConvertMarkdownToRst(iterFileLines(mdFile)):
+        yield line
+
+    yield ''
+
+
+def _formatDiff(mdFilename, rstFilename, lineNo, contextLines, actualLine, expectedLine):
+    '''
+        _formatDiff - Format the short diff shown for a mismatch
+
+            @param lineNo <int> - The line number (starting at 1) of the first mismatch
+
+            @param contextLines list<str> - The matching lines directly preceding the mismatch
+
+            @param actualLine None or <str> - The line in the restructed text, or None if it ended early
+
+            @param expectedLine None or <str> - The line from converting the markdown, or None if it ended early
+    '''
+    ret = [
+        '--- %s' %(rstFilename, ),
+        '+++ %s (converted)' %(mdFilename, ),
+        '@@ line %d @@' %(lineNo, ),
+    ]
+
+    ret += [ ' ' + contextLine for contextLine in contextLines ]
+
+    if actualLine is not None:
+        ret.append( '-' + actualLine )
+    if expectedLine is not None:
+        ret.append( '+' + expectedLine )
+
+    return '\n'.join(ret)
+
+
+def checkFile(mdFilename, rstFilename):
+    '''
+        checkFile - Check if an existing restructed text file matches what its markdown source converts to.
+
+            Both files are streamed (and decoded as utf-8), and comparison stops at the first line which does not match.
+
+            @param mdFilename <str> - The markdown source
+
+            @param rstFilename <str> - The existing restructed text
+
+            @return <CheckResult>
+    '''
+    try:
+        with io.open(mdFilename, 'rt', encoding='utf-8') as mdFile:
+            with io.open(rstFilename, 'rt', encoding='utf-8') as rstFile:
+
+                contextLines = collections.deque(maxlen=NUM_CONTEXT_LINES)
+
+                expectedLines = _iterExpectedLines(mdFile)
+                actualLines = iterFileLines(rstFile)
+
+                lineNo = 0
+                while True:
+                    lineNo += 1
+
+                    expectedLine = next(expectedLines, None)
+                    actualLine = next(actualLines, None)
+
+                    if expectedLine is None and actualLine is None:
+                        return CheckResult(mdFilename, rstFilename, True)
+
+                    if expectedLine != actualLine:
+                        diff = _formatDiff(mdFilename, rstFilename, lineNo, contextLines, actualLine, expectedLine)
+                        return CheckResult(mdFilename, rstFilename, False, diff=diff)
+
+                    contextLines.append(expectedLine)
+
+    # UnicodeDecodeError is a ValueError
+    except (IOError, OSError, ValueError) as e:
+        return CheckResult(mdFilename, rstFilename, False, error='%s:  %s' %(type(e).__name__, str(e)))
+
+
+def _checkFilePair(pair):
+    '''
+        _checkFilePair - Wrapper around #checkFile taking a single tuple, for use with multiprocessing.Pool.imap
+    '''
+    return checkFile(*pair)
+
+
+def checkFiles(pairs, jobs=None):
+    '''
+        checkFiles - Check many markdown / restructed text pairs, in parallel.
+
+            @param pairs list< tuple(str, str) > - A list of ( markdown filename, restructed text filename )
+
+            @param jobs None or <int> - The number of processes to use. If None, the number of cpus is used.
+                If 1, the checks are run in this process.
+
+            @return list<CheckResult> - The results, in the same order as #pairs
+    '''
+    pairs = list(pairs)
+
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+    jobs = min(jobs, len(pairs))
+
+    if jobs <= 1:
+        return [ _checkFilePair(pair) for pair in pairs ]
+
+    pool = multiprocessing.Pool(jobs)
+    try:
+        return list( pool.imap(_checkFilePair, pairs) )
+    finally:
+        pool.close()
+        pool.join()
+
+
+# vim: set ts=4 sw=4 st=4 expandtab :
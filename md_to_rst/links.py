@@ -0,0 +1,221 @@
+# vim: set ts=4 sw=4 st=4 expandtab
+'''
+    md_to_rst - Module whose purpose is to convert markdown (md) to restructed text (rst)
+
+    Copyright (c) 2017 Timothy Savannah, All Rights Reserved
+
+    Licensed under terms of the GNU General Public License (GPL) Version 3.0
+
+    You should have recieved a copy of this license as "LICENSE" with the source distribution,
+      otherwise the current license can be found at https://github.com/kata198/mdToRst/blob/master/LICENSE
+
+
+    md_to_rst/links.py - Rewriting and validation of relative links when converting a tree of documents
+'''
+
+import os
+import posixpath
+import re
+
+__all__ = ('FileIndex', 'LinkRewriter', 'DEFAULT_LINK_EXTENSION_MAP')
+
+
+# DEFAULT_LINK_EXTENSION_MAP - The default mapping of link target extension -> replacement extension
+DEFAULT_LINK_EXTENSION_MAP = { '.md' : '.rst' }
+
+
+class FileIndex(object):
+    '''
+        FileIndex - An index of every file and directory within a tree, built once up front.
+
+          Links are validated against this index rather than with a filesystem call per link,
+            so validating every link in a very large tree stays cheap.
+
+          All paths within the index are relative to the root, use "/" as the separator, and are normalized.
+    '''
+
+    def __init__(self, rootDir, relativePaths=None):
+        '''
+            __init__ - Create a FileIndex
+
+                @param rootDir <str> - The root directory of the tree
+
+                @param relativePaths None or iterable<str> - If provided, the paths of all the files (relative to #rootDir)
+                    within the tree. This allows a caller which has already walked the tree to skip a second walk.
+
+                    If None, #rootDir will be walked to collect them.
+        '''
+        self.rootDir = rootDir
+
+        self.files = set()
+        self.directories = set( ['.'] )
+
+        if relativePaths is None:
+            relativePaths = self._walk(rootDir)
+
+        for relativePath in relativePaths:
+            self.addFile(relativePath)
+
+
+    @staticmethod
+    def _walk(rootDir):
+        '''
+            _walk - Generator which yields the relative path of every file under #rootDir
+        '''
+        for dirPath, dirNames, fileNames in os.walk(rootDir):
+            relativeDir = os.path.relpath(dirPath, rootDir)
+            for fileName in fileNames:
+                yield os.path.join(relativeDir, fileName)
+
+
+    @staticmethod
+    def normalizePath(relativePath):
+        '''
+            normalizePath - Normalize a relative path into the form used by the index
+
+                @param relativePath <str> - A path relative to the root
+
+                @return <str> - The normalized path ( "/" separated, no "./" or redundant components )
+        '''
+        if os.sep != '/':
+            relativePath = relativePath.replace(os.sep, '/')
+
+        return posixpath.normpath(relativePath)
+
+
+    def addFile(self, relativePath):
+        '''
+            addFile - Add a file (and all of its parent directories) to the index
+
+                @param relativePath <str> - Path of the file, relative to the root
+        '''
+        relativePath = self.normalizePath(relativePath)
+
+        self.files.add(relativePath)
+
+        dirName = posixpath.dirname(relativePath)
+        while dirName and dirName not in self.directories:
+            self.directories.add(dirName)
+            dirName = posixpath.dirname(dirName)
+
+
+    def hasFile(self, relativePath):
+        '''
+            hasFile - Check if a file exists within the index
+
+                @param relativePath <str> - Path of the file, relative to the root
+        '''
+        return self.normalizePath(relativePath) in self.files
+
+
+    def hasPath(self, relativePath):
+        '''
+            hasPath - Check if a file or directory exists within the index
+
+                @param relativePath <str> - Path, relative to the root
+        '''
+        relativePath = self.normalizePath(relativePath)
+
+        return relativePath in self.files or relativePath in self.directories
+
+
+    def getLinkRewriter(self, sourceFilename, extensionMap=None):
+        '''
+            getLinkRewriter - Get a #LinkRewriter for a document within this tree
+
+                @param sourceFilename <str> - The path of the markdown document being converted, relative to the root
+
+                @param extensionMap None or dict<str:str> - @see LinkRewriter.__init__
+
+                @return <LinkRewriter>
+        '''
+        return LinkRewriter(self, sourceFilename, extensionMap)
+
+    def __len__(self):
+        return len(self.files)
+
+    def __contains__(self, relativePath):
+        return self.hasPath(relativePath)
+
+
+class LinkRewriter(object):
+    '''
+        LinkRewriter - Rewrites the relative links within a single document, based on a #FileIndex.
+
+          Relative links to a file with an extension in the extension map (by default, ".md") have their extension
+            replaced (by default, with ".rst"). Links with a scheme (like http://), anchor-only links, and links
+            which point outside the root of the tree are passed through unchanged.
+
+          A relative link whose target is not in the index is also passed through unchanged, and is recorded in #brokenLinks
+    '''
+
+    # URL_SCHEME_RE - Matches a url which begins with a scheme ( like http: or mailto: ), and thus is not relative
+    URL_SCHEME_RE = re.compile('^[a-zA-Z][a-zA-Z0-9+.\\-]*[:]')
+
+    # URL_SUFFIX_RE - Splits the path portion of a url from any query or fragment
+    URL_SUFFIX_RE = re.compile('^(?P<path>[^?#]*)(?P<suffix>.*)$')
+
+    def __init__(self, fileIndex, sourceFilename, extensionMap=None):
+        '''
+            __init__ - Create a LinkRewriter
+
+                @param fileIndex <FileIndex> - The index of the tree
+
+                @param sourceFilename <str> - The path of the markdown document being converted, relative to the root of #fileIndex
+
+                @param extensionMap None or dict<str:str> - A map of link target extension to the extension it should be replaced with.
+                    If None, #DEFAULT_LINK_EXTENSION_MAP is used ( .md -> .rst )
+        '''
+        self.fileIndex = fileIndex
+        self.sourceFilename = FileIndex.normalizePath(sourceFilename)
+        self.sourceDir = posixpath.dirname(self.sourceFilename)
+
+        if extensionMap is None:
+            extensionMap = DEFAULT_LINK_EXTENSION_MAP
+        self.extensionMap = extensionMap
+
+        # brokenLinks - The urls found in this document which point to a file not within the index
+        self.brokenLinks = []
+
+    def rewriteUrl(self, url):
+        '''
+            rewriteUrl - Rewrite a single url from a link
+
+                @param url <str> - The url, as it appears in the markdown
+
+                @return <str> - The url as it should appear in the RST
+        '''
+        if not url or url.startswith('#') or self.URL_SCHEME_RE.match(url):
+            return url
+
+        matchObj = self.URL_SUFFIX_RE.match(url)
+        groupDict = matchObj.groupdict()
+
+        urlPath = groupDict['path']
+        if not urlPath:
+            return url
+
+        if urlPath.startswith('/'):
+            # Absolute paths are relative to the root of the tree
+            targetPath = posixpath.normpath(urlPath.lstrip('/'))
+        else:
+            targetPath = posixpath.normpath(posixpath.join(self.sourceDir, urlPath))
+
+        if targetPath == '..' or targetPath.startswith('../'):
+            # Outside of the tree, we cannot tell if it is valid or not.
+            return url
+
+        if not self.fileIndex.hasPath(targetPath):
+            self.brokenLinks.append(url)
+            return url
+
+        (urlPathBase, urlPathExt) = posixpath.splitext(urlPath)
+        if urlPathExt in self.extensionMap and self.fileIndex.hasFile(targetPath):
+            return urlPathBase + self.extensionMap[urlPathExt] + groupDict['suffix']
+
+        return url
+
+    __call__ = rewriteUrl
+
+
+# vim: set ts=4 sw=4 st=4 expandtab :